@@ -12,6 +12,7 @@ except:
 
 from machine import Pin
 import network
+import time
 
 import esp
 esp.osdebug(None)
@@ -22,15 +23,32 @@ gc.collect()
 ssid = 'nikhuge'
 password = ''
 
+# Access point started when the station can't connect, so the UI stays reachable
+ap_ssid = 'KC868-A16'
+ap_password = 'kc868a16'
+
 station = network.WLAN(network.STA_IF)
 
 station.active(True)
 station.connect(ssid, password)
 
-while station.isconnected() == False:
-  pass
-
-print('Connection successful')
-print(station.ifconfig())
+# Sleep between checks so the WiFi driver gets CPU time while associating
+for _ in range(200):  # 20s
+  if station.isconnected():
+    break
+  time.sleep_ms(100)
+
+if station.isconnected():
+  print('Connection successful')
+  print(station.ifconfig())
+else:
+  print('Could not connect to ' + ssid + ', starting access point ' + ap_ssid)
+  # Stop the station from rescanning; it would move the radio's channel and drop AP clients
+  station.disconnect()
+  station.active(False)
+  ap = network.WLAN(network.AP_IF)
+  ap.active(True)
+  ap.config(essid=ap_ssid, password=ap_password, authmode=network.AUTH_WPA_WPA2_PSK)
+  print(ap.ifconfig())
 
 led = Pin(2, Pin.OUT)
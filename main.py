@@ -1,12 +1,15 @@
 import time
 import network
-import ujson
+import _thread
+import hashlib
+import binascii
 from machine import Pin, I2C
 import uasyncio as asyncio
 
 # --- Hardware Configuration ---
 PIN_I2C_SDA = 4
 PIN_I2C_SCL = 5
+I2C_FREQ = 400000  # every device on the bus is a PCF8574, rated for 400 kHz fast-mode
 
 ADDR_INPUTS_1_8 = 0x22
 ADDR_INPUTS_9_16 = 0x21
@@ -17,12 +20,39 @@ PIN_HT1 = 32
 PIN_HT2 = 33
 PIN_HT3 = 14
 
+# Open-drain INT outputs of both input PCF8574s, wired together to a spare GPIO
+PIN_PCF_INT = 13
+DEBOUNCE_MS = 50
+
+# --- Web Server Configuration ---
+# Idle connections are kept open this long (seconds) for the next request
+KEEP_ALIVE_TIMEOUT = 15
+KEEP_ALIVE_HEADERS = b"Connection: keep-alive\r\nKeep-Alive: timeout=%d\r\n" % KEEP_ALIVE_TIMEOUT
+CLOSE_HEADERS = b"Connection: close\r\n"
+# Size of the per-connection buffer the request line and headers are read into
+REQUEST_HEAD_MAX = 2048
+
+def http_response(status, body, content_type=b"text/plain", extra_headers=b"", keep_alive=True):
+    """Builds a complete response so it can be sent with a single write."""
+    # Only %d is interpolated: MicroPython formats bytes passed to %s as b'...'
+    return (b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type + b"\r\n" + extra_headers +
+            (KEEP_ALIVE_HEADERS if keep_alive else CLOSE_HEADERS) +
+            b"Content-Length: %d\r\n\r\n" % len(body) + body)
+
 # --- Helper Class for PCF8574 ---
 class PCF8574:
-    def __init__(self, i2c_bus, address):
+    def __init__(self, i2c_bus, address, lock):
         self.i2c = i2c_bus
         self.address = address
+        # Shared by every device on the bus: the scan thread and the web
+        # server both do I2C transfers and read-modify-writes of value
+        self.lock = lock
+        # value is the last byte written (outputs); last_read the last byte
+        # read (inputs). Reads never touch value, so output state stays intact.
         self.value = 0xFF 
+        self.last_read = None
+        self._cache_tick = -1
+        self._buf = bytearray(1)  # reused by read_all to avoid a heap allocation per read
         self.is_valid = True
         try:
             self.i2c.scan()
@@ -31,36 +61,61 @@ class PCF8574:
             print(f"I2C device not found at address 0x{self.address:x}")
             self.is_valid = False
 
-    def read_all(self):
+    def invalidate(self):
+        self._cache_tick = -1
+
+    def read_all(self, tick=None):
+        # Reuse the byte already fetched during this scan tick instead of
+        # issuing another I2C transaction.
         if not self.is_valid: return None
-        try:
-            self.value = self.i2c.readfrom(self.address, 1)[0]
-            return self.value
-        except OSError as e:
-            # print(f"I2C read error on address 0x{self.address:x}: {e}")
-            return None
+        with self.lock:
+            if tick is not None and tick == self._cache_tick:
+                return self.last_read
+            try:
+                self.i2c.readfrom_into(self.address, self._buf)
+                self.last_read = self._buf[0]
+                self._cache_tick = -1 if tick is None else tick
+                return self.last_read
+            except OSError as e:
+                # print(f"I2C read error on address 0x{self.address:x}: {e}")
+                self.invalidate()
+                return None
 
     def read_pin(self, pin_number):
         if not self.is_valid: return False
-        if self.read_all() is not None:
-            return not bool(self.value & (1 << pin_number))
+        value = self.read_all()
+        if value is not None:
+            return not bool(value & (1 << pin_number))
         return False
 
-    def write_all(self, value):
-        if not self.is_valid: return
+    def _write(self, value):
+        # Caller holds self.lock; value is only committed on success
         try:
             self.i2c.writeto(self.address, bytes([value]))
             self.value = value
         except OSError as e:
             print(f"I2C write error on address 0x{self.address:x}: {e}")
 
+    def write_all(self, value):
+        if not self.is_valid: return
+        with self.lock:
+            self._write(value)
+
     def write_pin(self, pin_number, state):
         if not self.is_valid: return
-        if not state:
-            self.value &= ~(1 << pin_number)
-        else:
-            self.value |= (1 << pin_number)
-        self.write_all(self.value)
+        with self.lock:
+            # Start from the last written byte
+            if not state:
+                self._write(self.value & ~(1 << pin_number))
+            else:
+                self._write(self.value | (1 << pin_number))
+
+    def toggle_pin(self, pin_number):
+        """Flips one output bit and returns whether it is now set."""
+        if not self.is_valid: return False
+        with self.lock:
+            self._write(self.value ^ (1 << pin_number))
+            return bool(self.value & (1 << pin_number))
 
 # --- Web Server HTML Generation ---
 HTML_PAGE = """
@@ -108,7 +163,7 @@ HTML_PAGE = """
 
     <script>
         // This is the JavaScript that runs in the browser
-        const updateInterval = 1000; // 1 second
+        const reconnectDelay = 2000; // 2 seconds
         
         const createRelayToggleButton = (id, state) => {
             const button = document.createElement('button');
@@ -131,11 +186,8 @@ HTML_PAGE = """
             }
         };
         
-        const updateUI = async () => {
+        const render = (data) => {
             try {
-                const response = await fetch('/api/state');
-                const data = await response.json();
-                
                 // Update relay buttons
                 const relayContainer = document.getElementById('relay-buttons-container');
                 relayContainer.innerHTML = '';
@@ -177,47 +229,161 @@ HTML_PAGE = """
                     inputContainer.appendChild(p);
                 }
 
+            } catch (error) {
+                console.error('Error rendering state:', error);
+            }
+        };
+
+        // The server pushes the full state on connect and whenever it changes
+        const connect = () => {
+            const ws = new WebSocket(`ws://${location.host}/ws`);
+            ws.onmessage = (event) => render(JSON.parse(event.data));
+            ws.onclose = () => setTimeout(connect, reconnectDelay);
+        };
+
+        // Fallback for browsers without WebSocket: long-poll /api/state, which
+        // only answers once the state moves past the version we last saw
+        const poll = async (version) => {
+            try {
+                const response = await fetch(`/api/state?v=${version}`);
+                if (response.status === 200) {
+                    const data = await response.json();
+                    render(data);
+                    version = data.version;
+                }
+                poll(version);
             } catch (error) {
                 console.error('Error fetching state:', error);
+                setTimeout(() => poll(version), reconnectDelay);
             }
         };
 
-        // Initial UI update and start the polling loop
-        updateUI();
-        setInterval(updateUI, updateInterval);
+        if ('WebSocket' in window) {
+            connect();
+        } else {
+            poll(-1);
+        }
     </script>
 </body>
 </html>
 """
-def get_html_page():
-    return HTML_PAGE
+def gzip_bytes(data):
+    """Compress data into a gzip stream using MicroPython's deflate module."""
+    import io
+    import deflate
+    buf = io.BytesIO()
+    stream = deflate.DeflateIO(buf, deflate.GZIP, 10)
+    stream.write(data)
+    stream.close()
+    return buf.getvalue()
+
+# The page never changes, so encode, compress and build the full keep-alive
+# responses once. Clients that don't accept gzip (curl, scripts) get the plain
+# page.
+HTML_VARY = b"Vary: Accept-Encoding\r\n"
+HTML_PAGE_BYTES = HTML_PAGE.encode('utf-8')
+try:
+    HTML_PAGE_GZIP = gzip_bytes(HTML_PAGE_BYTES)
+except Exception as e:
+    # Firmware built without deflate compression: only the plain page is served
+    print(f"HTML compression unavailable: {e}")
+    HTML_PAGE_GZIP = None
+HTML_PLAIN_RESPONSE = http_response(b"200 OK", HTML_PAGE_BYTES, b"text/html", HTML_VARY)
+HTML_GZIP_RESPONSE = None
+if HTML_PAGE_GZIP is not None:
+    HTML_GZIP_RESPONSE = http_response(b"200 OK", HTML_PAGE_GZIP, b"text/html",
+                                       HTML_VARY + b"Content-Encoding: gzip\r\n")
 
 # --- Hardware Instances (Global) ---
-i2c0 = I2C(0, sda=Pin(PIN_I2C_SDA), scl=Pin(PIN_I2C_SCL))
+i2c0 = I2C(0, sda=Pin(PIN_I2C_SDA), scl=Pin(PIN_I2C_SCL), freq=I2C_FREQ)
 sensor_ht1 = Pin(PIN_HT1, Pin.IN, Pin.PULL_UP)
 sensor_ht2 = Pin(PIN_HT2, Pin.IN, Pin.PULL_UP)
 sensor_ht3 = Pin(PIN_HT3, Pin.IN, Pin.PULL_UP)
 
-pcf_inputs_1_8 = PCF8574(i2c0, ADDR_INPUTS_1_8)
-pcf_inputs_9_16 = PCF8574(i2c0, ADDR_INPUTS_9_16)
-pcf_outputs_1_8 = PCF8574(i2c0, ADDR_OUTPUTS_1_8)
-pcf_outputs_9_16 = PCF8574(i2c0, ADDR_OUTPUTS_9_16)
+i2c_lock = _thread.allocate_lock()
+pcf_inputs_1_8 = PCF8574(i2c0, ADDR_INPUTS_1_8, i2c_lock)
+pcf_inputs_9_16 = PCF8574(i2c0, ADDR_INPUTS_9_16, i2c_lock)
+pcf_outputs_1_8 = PCF8574(i2c0, ADDR_OUTPUTS_1_8, i2c_lock)
+pcf_outputs_9_16 = PCF8574(i2c0, ADDR_OUTPUTS_9_16, i2c_lock)
 
-# Map relay numbers to their corresponding PCF and pin number
-outputs_map = {
-    str(i + 1): (pcf_outputs_1_8, i) for i in range(8)
-}
-outputs_map.update({
-    str(i + 9): (pcf_outputs_9_16, i) for i in range(8)
-})
-
-# Map input PCF pins to output names
-input_to_output_map = {
-    pcf_inputs_1_8.address: {i: str(i + 1) for i in range(8)},
-    pcf_inputs_9_16.address: {i: str(i + 9) for i in range(8)},
+# The input PCFs pull INT low whenever a pin changes; the line is released
+# again once the port is read. input_lock is used as a semaphore: the scan
+# thread blocks acquiring it and the IRQs release it. It starts unlocked so
+# the first pass runs straight away.
+input_lock = _thread.allocate_lock()
+
+def wake_scanner():
+    try:
+        input_lock.release()
+    except RuntimeError:
+        pass  # already released; the pending scan covers this change too
+
+def on_input_irq(pin):
+    wake_scanner()
+
+pcf_int_pin = Pin(PIN_PCF_INT, Pin.IN, Pin.PULL_UP)
+pcf_int_pin.irq(trigger=Pin.IRQ_FALLING, handler=on_input_irq)
+for sensor in (sensor_ht1, sensor_ht2, sensor_ht3):
+    sensor.irq(trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, handler=on_input_irq)
+
+# Set by the scan thread and the relay control handler when inputs or relays
+# change; the publish_state task is the only caller of notify_state()
+state_changed_flag = asyncio.ThreadSafeFlag()
+
+# Relays 1-8 live on the first output PCF and 9-16 on the second
+OUT_BANKS = (pcf_outputs_1_8, pcf_outputs_9_16)
+NUM_RELAYS = 16
+
+def relay_lookup(relay_num):
+    """Maps a relay number (1-16) to its output PCF and pin number."""
+    return OUT_BANKS[(relay_num - 1) >> 3], (relay_num - 1) & 7
+
+# Bit lookup tables for the input diff: MASKS[i] is pin i's mask and
+# BITS_SET[b] lists the pins set in byte b, so only changed pins are visited
+MASKS = (1, 2, 4, 8, 16, 32, 64, 128)
+BITS_SET = tuple(tuple(i for i in range(8) if (b >> i) & 1) for b in range(256))
+
+# Relay number toggled by each input pin, per input PCF address
+input_to_relay_int = {
+    pcf_inputs_1_8.address: [i + 1 for i in range(8)],
+    pcf_inputs_9_16.address: [i + 9 for i in range(8)],
 }
 
+# Incremented by the scan_keys thread on every pass; PCF reads tagged with the same tick
+# are served from the expander's cached byte.
+current_tick = 0
+
+# Bumped by notify_state whenever a relay or input changes. Long-poll requests
+# to /api/state wait on state_event until the version moves past theirs.
+state_version = 0
+state_event = asyncio.Event()
+LONG_POLL_TIMEOUT = 20
+
 # --- New Async Web Server Class ---
+def header_value(head, name):
+    """Returns the value of a header in a raw request head, or None if absent.
+
+    name is lowercase bytes. Only lines whose name has the same length are
+    sliced and lowered, so most lines are skipped without allocating.
+    """
+    n = len(name)
+    start = head.find(b"\r\n") + 2
+    while True:
+        end = head.find(b"\r\n", start)
+        if end <= start:  # the blank line ending the head
+            return None
+        if end > start + n and head[start + n] == 0x3A and head[start:start + n].lower() == name:
+            return head[start + n + 1:end].strip()
+        start = end + 2
+
+def query_param(query, name):
+    """Returns the value of `name` in a raw query string, or None if absent."""
+    for param in query.split('&'):
+        key, _, value = param.partition('=')
+        if key == name:
+            return value
+    return None
+
 class AsyncWebServer:
     def __init__(self, host='0.0.0.0', port=80):
         self.host = host
@@ -235,31 +401,81 @@ class AsyncWebServer:
         print(f"Web server started on {self.host}:{self.port}")
         await server.wait_closed()
 
+    async def read_head(self, reader, buf, held, timeout):
+        """Reads a request line and headers into buf in as few reads as possible.
+
+        buf may already start with `held` bytes of a pipelined request. Returns
+        the head including its closing blank line (None on EOF, b"" if it does
+        not fit in buf) and the number of bytes of the following request left
+        at the start of buf.
+        """
+        mv = memoryview(buf)
+        data = bytes(mv[:held])
+        while True:
+            end = data.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if held == len(buf):
+                return b"", 0
+            count = await asyncio.wait_for(reader.readinto(mv[held:]), timeout=timeout)
+            if not count:
+                return None, 0
+            held += count
+            data = bytes(mv[:held])
+            timeout = 3.0
+        end += 4
+        rest = held - end
+        if not rest:
+            return data, 0
+        buf[:rest] = data[end:]
+        return data[:end], rest
+
     async def handle_client(self, reader, writer):
+        # Serve requests on this connection until the client closes it, asks
+        # for Connection: close, or stays idle for KEEP_ALIVE_TIMEOUT
+        timeout = 3.0
+        buf = bytearray(REQUEST_HEAD_MAX)
+        held = 0
         try:
-            request_line = await asyncio.wait_for(reader.readline(), timeout=3.0)
-            if not request_line:
-                return
-
-            request_line_str = request_line.decode('utf-8').strip()
-            # print("Request:", request_line_str)
-            
-            while await asyncio.wait_for(reader.readline(), timeout=3.0) != b"\r\n":
-                pass
-
-            method, path, _ = request_line_str.split(' ')
-            path_base = path.split('?')[0]
-            
-            handler = self.routes.get(path_base)
-            if handler:
-                await handler(reader, writer, path)
-            else:
-                writer.write(b"HTTP/1.1 404 Not Found\r\n")
-                writer.write(b"Content-Type: text/plain\r\n\r\n")
-                writer.write(b"404 Not Found")
+            while True:
+                head, held = await self.read_head(reader, buf, held, timeout)
+                if head is None:
+                    return
+                if not head:
+                    writer.write(http_response(b"431 Request Header Fields Too Large", b"Request headers too large",
+                                               keep_alive=False))
+                    return
+
+                # Headers stay in the raw head; header_value() looks up only the
+                # few that are needed
+                request_line_str = head[:head.find(b"\r\n")].decode('utf-8')
+                # print("Request:", request_line_str)
+
+                method, path, version = request_line_str.split(' ')
+                path_base, _, query = path.partition('?')
+
+                # Decided before dispatch so the response can carry the right
+                # Connection header
+                connection = header_value(head, b"connection")
+                keep_alive = version == 'HTTP/1.1' and not (connection and connection.lower() == b"close")
+                
+                handler = self.routes.get(path_base)
+                if handler:
+                    # A handler returns True when it has taken over the connection
+                    if await handler(reader, writer, query, head, keep_alive):
+                        return
+                else:
+                    writer.write(http_response(b"404 Not Found", b"404 Not Found", keep_alive=keep_alive))
+                await writer.drain()
+
+                if not keep_alive:
+                    return
+                timeout = KEEP_ALIVE_TIMEOUT
 
         except asyncio.TimeoutError:
-            print("Request timed out.")
+            # Idle keep-alive connections time out as a matter of course
+            if timeout != KEEP_ALIVE_TIMEOUT:
+                print("Request timed out.")
         except Exception as e:
             print(f"Error handling request: {e}")
         finally:
@@ -267,10 +483,81 @@ class AsyncWebServer:
             writer.close()
             await writer.wait_closed()
 
+# --- WebSocket Helpers ---
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_OP_TEXT = 0x1
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+# Client payloads are only ever pings and closes, which are capped at 125 bytes
+WS_MAX_PAYLOAD = 125
+
+# Writers of connected WebSocket clients that receive state pushes, each with
+# a lock so broadcast and ws_handler never drain the same stream at once
+ws_clients = {}
+
+def ws_frame(payload, opcode=WS_OP_TEXT):
+    """Builds a single unmasked server-to-client frame."""
+    n = len(payload)
+    if n < 126:
+        header = bytes((0x80 | opcode, n))
+    else:
+        header = bytes((0x80 | opcode, 126, n >> 8, n & 0xFF))
+    return header + payload
+
+async def ws_recv(reader):
+    """Reads one client frame and returns (opcode, unmasked payload)."""
+    header = await reader.readexactly(2)
+    opcode = header[0] & 0x0F
+    n = header[1] & 0x7F
+    if n == 126:
+        ext = await reader.readexactly(2)
+        n = (ext[0] << 8) | ext[1]
+    elif n == 127:
+        ext = await reader.readexactly(8)
+        n = int.from_bytes(ext, 'big')
+    if n > WS_MAX_PAYLOAD:
+        raise ValueError("WebSocket frame too large")
+    mask = await reader.readexactly(4) if header[1] & 0x80 else None
+    payload = bytearray(await reader.readexactly(n)) if n else bytearray()
+    if mask:
+        for i in range(n):
+            payload[i] ^= mask[i & 3]
+    return opcode, payload
+
+async def broadcast(message):
+    """Sends a text frame to every WebSocket client, dropping dead ones."""
+    frame = ws_frame(message)
+    for client, lock in list(ws_clients.items()):
+        try:
+            async with lock:
+                client.write(frame)
+                await client.drain()
+        except Exception as e:
+            print(f"Dropping WebSocket client: {e}")
+            ws_clients.pop(client, None)
+            # Closing makes the browser notice and reconnect
+            client.close()
+
+async def notify_state():
+    """Publishes a state change to long-poll waiters and WebSocket clients."""
+    global state_version
+    state_version += 1
+    # Waiting tasks are already scheduled by set(), so clearing right away is safe
+    state_event.set()
+    state_event.clear()
+    if ws_clients:
+        await broadcast(build_state())
+
 # --- Application Logic ---
 app = AsyncWebServer()
 
 def do_connect():
+    # boot.py fell back to its access point; bringing the station back up
+    # would make the radio scan and disconnect AP clients
+    if network.WLAN(network.AP_IF).active():
+        print('Access point active, skipping station connect.')
+        return
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
     if not wlan.isconnected():
@@ -285,128 +572,212 @@ def do_connect():
         else:
             print('Could not connect to network.')
 
+# Pre-encoded JSON fragments for build_state(); the schema never changes, so
+# every key/value pair is built once here and only picked per request
+JSON_RELAY_ON = tuple(b'"%d":"on"' % (i + 1) for i in range(16))
+JSON_RELAY_OFF = tuple(b'"%d":"off"' % (i + 1) for i in range(16))
+JSON_INPUT_TRUE = tuple(b'"X%02d":true' % (i + 1) for i in range(16))
+JSON_INPUT_FALSE = tuple(b'"X%02d":false' % (i + 1) for i in range(16))
+JSON_HT_KEYS = (b'"HT1":', b'"HT2":', b'"HT3":')
+JSON_BOOL = (b"false", b"true")
+
+def build_state():
+    """Returns the current state of all relays and inputs as JSON bytes."""
+    
+    # Get outputs state; a set bit is displayed as "on". Both output bytes and
+    # the lookup tables are bound to locals once, outside the per-relay loops.
+    v1 = pcf_outputs_1_8.value
+    v2 = pcf_outputs_9_16.value
+    masks = MASKS
+    on = JSON_RELAY_ON
+    off = JSON_RELAY_OFF
+    relays = []
+    for i in range(8):
+        relays.append(on[i] if v1 & masks[i] else off[i])
+    for i in range(8):
+        relays.append(on[i + 8] if v2 & masks[i] else off[i + 8])
+
+    # Get inputs state (active-low)
+    inputs = [
+        JSON_HT_KEYS[0] + JSON_BOOL[not sensor_ht1.value()],
+        JSON_HT_KEYS[1] + JSON_BOOL[not sensor_ht2.value()],
+        JSON_HT_KEYS[2] + JSON_BOOL[not sensor_ht3.value()],
+    ]
+    # Read each input PCF once and unpack the bits, again through locals
+    in1 = pcf_inputs_1_8.read_all(tick=current_tick)
+    in2 = pcf_inputs_9_16.read_all(tick=current_tick)
+    active = JSON_INPUT_TRUE
+    inactive = JSON_INPUT_FALSE
+    # A failed read reports every pin of that bank as false, as read_pin() did
+    if in1 is None:
+        in1 = 0xFF
+    if in2 is None:
+        in2 = 0xFF
+    for i in range(8):
+        inputs.append(inactive[i] if in1 & masks[i] else active[i])
+    for i in range(8):
+        inputs.append(inactive[i + 8] if in2 & masks[i] else active[i + 8])
+
+    return (b'{"version":%d,"relays":{' % state_version + b",".join(relays) +
+            b'},"inputs":{' + b",".join(inputs) + b"}}")
+
 @app.route('/')
-async def index_handler(reader, writer, path):
+async def index_handler(reader, writer, query, head, keep_alive):
     """Main handler for the web page and control requests."""
     # Check for a relay control request via query parameters
-    if '?' in path:
+    if query:
         try:
-            query = path.split("?")[1]
-            params = dict(param.split("=") for param in query.split("&"))
-            
-            relay_id = params.get("relay")
-            state = params.get("state")
-
-            if relay_id == "all" and state in ["on", "off"]:
-                state_value = True if state == "on" else False
-                for relay_num in outputs_map:
-                    pcf, pin_num = outputs_map[relay_num]
-                    pcf.write_pin(pin_num, state_value)
+            relay_id = query_param(query, "relay")
+            state = query_param(query, "state")
+            relay_num = int(relay_id) if relay_id and relay_id.isdigit() else 0
+
+            if relay_id == "all" and state in ("on", "off"):
+                # One write per bank; "on" sets the pin high, as write_pin(pin, True) does
+                value = 0xFF if state == "on" else 0x00
+                for pcf in OUT_BANKS:
+                    pcf.write_all(value)
                 print(f"All relays set to {state.upper()}")
-            elif relay_id in outputs_map and state in ["on", "off"]:
+                # publish_state pushes the change, so the reply doesn't wait on WebSocket clients
+                state_changed_flag.set()
+            elif 1 <= relay_num <= NUM_RELAYS and state in ("on", "off"):
                 state_value = True if state == "on" else False
-                pcf, pin_num = outputs_map[relay_id]
+                pcf, pin_num = relay_lookup(relay_num)
                 pcf.write_pin(pin_num, state_value)
                 print(f"Relay {relay_id} set to {state.upper()}")
+                state_changed_flag.set()
 
-            writer.write(b"HTTP/1.1 200 OK\r\n")
-            writer.write(b"Content-Type: text/plain\r\n\r\n")
-            writer.write(b"OK")
+            writer.write(http_response(b"200 OK", b"OK", keep_alive=keep_alive))
         except Exception as e:
             print(f"Error parsing request: {e}")
-            writer.write(b"HTTP/1.1 500 Internal Server Error\r\n")
-            writer.write(b"Content-Type: text/plain\r\n\r\n")
-            writer.write(f"Error: {e}".encode('utf-8'))
-        finally:
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-            return
+            writer.write(http_response(b"500 Internal Server Error", f"Error: {e}".encode('utf-8'),
+                                       keep_alive=keep_alive))
+        return
             
-    # Serve the main HTML page
-    html_response = get_html_page()
-    writer.write(b"HTTP/1.1 200 OK\r\n")
-    writer.write(b"Content-Type: text/html\r\n")
-    writer.write(b"Connection: close\r\n")
-    writer.write(f"Content-Length: {len(html_response)}\r\n".encode('utf-8'))
-    writer.write(b"\r\n")
-    writer.write(html_response.encode('utf-8'))
+    # Serve the main HTML page, compressed if the client accepts it
+    accept_encoding = header_value(head, b"accept-encoding")
+    gzip = HTML_PAGE_GZIP is not None and accept_encoding and b"gzip" in accept_encoding
+    if not keep_alive:
+        # Rare enough not to keep extra prebuilt copies of the page around
+        if gzip:
+            writer.write(http_response(b"200 OK", HTML_PAGE_GZIP, b"text/html",
+                                       HTML_VARY + b"Content-Encoding: gzip\r\n", keep_alive=False))
+        else:
+            writer.write(http_response(b"200 OK", HTML_PAGE_BYTES, b"text/html", HTML_VARY, keep_alive=False))
+    elif gzip:
+        writer.write(HTML_GZIP_RESPONSE)
+    else:
+        writer.write(HTML_PLAIN_RESPONSE)
 
 @app.route('/api/state')
-async def api_state_handler(reader, writer, path):
-    """API handler to return the current state of all relays and inputs in JSON format."""
-    
-    # Get inputs state
-    inputs_states = {
-        "HT1": not sensor_ht1.value(),
-        "HT2": not sensor_ht2.value(),
-        "HT3": not sensor_ht3.value()
-    }
-    # Read from PCF inputs
-    if pcf_inputs_1_8.is_valid:
-        for i in range(8):
-            inputs_states[f"X{i+1:02d}"] = pcf_inputs_1_8.read_pin(i)
-    if pcf_inputs_9_16.is_valid:
-        for i in range(8):
-            inputs_states[f"X{i+9:02d}"] = pcf_inputs_9_16.read_pin(i)
-
-    # Get outputs state
-    relays_state = {}
-    for relay_id, (pcf, pin_num) in outputs_map.items():
-        state = not bool(pcf.value & (1 << pin_num))
-        # This is the line that has been updated to reverse the display
-        relays_state[relay_id] = "off" if state else "on"
-
-    response_data = {
-        "relays": relays_state,
-        "inputs": inputs_states
-    }
-    
-    json_response = ujson.dumps(response_data)
-    writer.write(b"HTTP/1.1 200 OK\r\n")
-    writer.write(b"Content-Type: application/json\r\n")
-    writer.write(b"Connection: close\r\n")
-    writer.write(f"Content-Length: {len(json_response)}\r\n".encode('utf-8'))
-    writer.write(b"\r\n")
-    writer.write(json_response.encode('utf-8'))
-    
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
+async def api_state_handler(reader, writer, query, head, keep_alive):
+    """API handler to return the current state of all relays and inputs in JSON format.
+
+    With ?v=<version> matching the current state version the request is held
+    open until the state changes, or answered with 304 after LONG_POLL_TIMEOUT.
+    """
+    if query and query_param(query, 'v') == str(state_version):
+        try:
+            await asyncio.wait_for(state_event.wait(), LONG_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            writer.write(b"HTTP/1.1 304 Not Modified\r\n" +
+                         (KEEP_ALIVE_HEADERS if keep_alive else CLOSE_HEADERS) + b"\r\n")
+            return
 
-async def scan_keys():
-    """Asynchronously scans for button presses and toggles relays."""
-    print("Starting key scanning task.")
+    body = build_state()
+    writer.write(http_response(b"200 OK", body, b"application/json", keep_alive=keep_alive))
+
+@app.route('/ws')
+async def ws_handler(reader, writer, query, head, keep_alive):
+    """Upgrades the connection to a WebSocket and pushes state changes to it."""
+    key = header_value(head, b"sec-websocket-key")
+    if not key:
+        writer.write(http_response(b"400 Bad Request", b"Expected WebSocket upgrade", keep_alive=keep_alive))
+        return
+
+    accept = binascii.b2a_base64(hashlib.sha1(key + WS_GUID).digest())[:-1]
+    # Register before taking the snapshot, holding the lock: a broadcast that
+    # lands meanwhile waits and then sends the newer state, so none is missed
+    lock = asyncio.Lock()
+    try:
+        async with lock:
+            ws_clients[writer] = lock
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                         b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n" + ws_frame(build_state()))
+            await writer.drain()
+
+        # Client messages are not used; keep reading to answer pings and notice closes
+        while True:
+            opcode, payload = await ws_recv(reader)
+            if opcode == WS_OP_CLOSE:
+                async with lock:
+                    writer.write(ws_frame(b"", WS_OP_CLOSE))
+                    await writer.drain()
+                break
+            if opcode == WS_OP_PING:
+                async with lock:
+                    writer.write(ws_frame(payload, WS_OP_PONG))
+                    await writer.drain()
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        # Wait out a broadcast in flight before handle_client closes the stream
+        async with lock:
+            ws_clients.pop(writer, None)
+    return True
+
+def scan_keys():
+    """Scans for button presses and toggles relays; runs on its own thread."""
+    global current_tick
+    print("Starting key scanning thread.")
     pcf_inputs = {
         pcf_inputs_1_8.address: pcf_inputs_1_8,
         pcf_inputs_9_16.address: pcf_inputs_9_16
     }
     
     prev_state = {addr: pcf.read_all() for addr, pcf in pcf_inputs.items() if pcf.is_valid}
+    prev_sensors = (sensor_ht1.value(), sensor_ht2.value(), sensor_ht3.value())
     
     while True:
+        # Block until an input signals a change, then let contacts settle
+        input_lock.acquire()
+        time.sleep_ms(DEBOUNCE_MS)
+        current_tick += 1
+        changed = False
         try:
+            sensors = (sensor_ht1.value(), sensor_ht2.value(), sensor_ht3.value())
+            if sensors != prev_sensors:
+                prev_sensors = sensors
+                changed = True
+
             for addr, pcf in pcf_inputs.items():
                 if not pcf.is_valid: continue
-                current_state = pcf.read_all()
-                if current_state is None:
+                current_state = pcf.read_all(tick=current_tick)
+                if current_state is None or current_state == prev_state[addr]:
                     continue
 
+                changed = True
                 diff = prev_state[addr] ^ current_state
-                for i in range(8):
-                    if diff & (1 << i):
-                        if not (current_state & (1 << i)):
-                            relay_id = input_to_output_map[addr][i]
-                            pcf_out, pin_num = outputs_map[relay_id]
-                            
-                            current_relay_state = not bool(pcf_out.value & (1 << pin_num))
-                            new_relay_state = not current_relay_state
-                            pcf_out.write_pin(pin_num, new_relay_state)
-                            print(f"Input {i} on board 0x{addr:x} triggered relay {relay_id} to {'ON' if new_relay_state else 'OFF'}")
+                for i in BITS_SET[diff]:
+                    if not (current_state & MASKS[i]):
+                        relay_id = input_to_relay_int[addr][i]
+                        pcf_out, pin_num = relay_lookup(relay_id)
+                        new_relay_state = pcf_out.toggle_pin(pin_num)
+                        print(f"Input {i} on board 0x{addr:x} triggered relay {relay_id} to {'ON' if new_relay_state else 'OFF'}")
                 prev_state[addr] = current_state
+            if changed:
+                state_changed_flag.set()
         except Exception as e:
             print(f"Error in scan_keys: {e}")
-        await asyncio.sleep_ms(100)
+        # A change that landed mid-scan keeps the shared INT line low without
+        # producing a new falling edge
+        if not pcf_int_pin.value():
+            wake_scanner()
+
+async def publish_state():
+    """Pushes state changes to web clients; the only task that broadcasts."""
+    while True:
+        await state_changed_flag.wait()
+        await notify_state()
 
 # --- Entry Point ---
 if __name__ == "__main__":
@@ -416,9 +787,11 @@ if __name__ == "__main__":
         if pcf_outputs_1_8.is_valid: pcf_outputs_1_8.write_all(0xFF)
         if pcf_outputs_9_16.is_valid: pcf_outputs_9_16.write_all(0xFF)
         
+        _thread.start_new_thread(scan_keys, ())
+        
         tasks = [
             asyncio.create_task(app.run()),
-            asyncio.create_task(scan_keys())
+            asyncio.create_task(publish_state())
         ]
         
         asyncio.run(asyncio.gather(*tasks))